@@ -4,6 +4,8 @@ from waitress.server import create_server
 
 import paho.mqtt.client as mqtt
 import paho.mqtt.publish as mqtt_publish
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
 
 import logging
 
@@ -17,9 +19,22 @@ from urllib.parse import unquote
 from json import loads as json_loads, dumps as json_dumps, JSONDecodeError
 from xmltodict import parse as xmlparse
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 import argparse as ap
 import random as rnd
 import string
+from collections import OrderedDict, deque
+from hashlib import sha1, sha256
+import hmac
+from threading import Lock, Thread
+from multiprocessing import get_context, TimeoutError as PoolTimeoutError
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from time import monotonic, time, sleep
 from datetime import datetime as dt
 from signal import signal, Signals, SIGTERM, SIGINT
 
@@ -29,17 +44,28 @@ parser.add_argument('--listen-port', type=int, default=5555, help='Listening por
 parser.add_argument('--listen-url', required=True, type=str, help='URL we should advertise to Foscam device')
 parser.add_argument('--obfuscate', action='store_true', help='Obfuscate webhook actions')
 parser.add_argument('--paranoid', action='store_true', help='Cycle obfuscated webhook action after each trigger')
+parser.add_argument('--webhook-secret', type=str, help='Shared secret to sign obfuscated webhook actions with, so they can be verified by any instance (default: none)')
+parser.add_argument('--webhook-rotation', type=int, default=0, help='Seconds after which signed webhook actions are rotated, 0 to never rotate (default: 0)')
+parser.add_argument('--webhook-rate', type=float, default=1.0, help='Webhook requests per second allowed from a single address, 0 to disable rate limiting (default: 1.0)')
+parser.add_argument('--webhook-burst', type=int, default=10, help='Webhook requests allowed in a burst from a single address (default: 10)')
 parser.add_argument('--foscam-host', type=str, help='Foscam VD1 IP/hostname to connect to for auto-configuration of webhooks')
 parser.add_argument('--foscam-port', type=int, default=88, help='Foscam VD1 port to connect to (default: 88)')
 parser.add_argument('--foscam-ssl', action='store_true', help='Enable SSL encryption on Foscam connection (default: false, use --foscam-port 443 for this)')
 parser.add_argument('--foscam-user', type=str, default='admin', help='Username to use for connecting to Foscam device')
 parser.add_argument('--foscam-pass', type=str, help='Password to use for connecting')
+parser.add_argument('--health-interval', type=int, default=30, help='Seconds between checks whether the Foscam device responds, 0 to disable (default: 30)')
+parser.add_argument('--health-max-interval', type=int, default=300, help='Maximum seconds between checks while the Foscam device is unreachable (default: 300)')
 parser.add_argument('--mqtt-host', type=str, default='localhost', help='MQTT server to connect to')
 parser.add_argument('--mqtt-port', type=int, default=1883, help='MQTT TCP port to connect to (default: 1883)')
 parser.add_argument('--mqtt-ssl', action='store_true', help='Enable SSL encryption on MQTT connection (default: false)')
 parser.add_argument('--mqtt-user', type=str, help='Username to use for connecting (default: none)')
 parser.add_argument('--mqtt-pass', type=str, help='Password to use for connecting (only used when username is specified)')
 parser.add_argument('--mqtt-topic', type=str, default='foscam2mqtt', help='MQTT topic to publish to (default: foscam2mqtt)')
+parser.add_argument('--mqtt-v5', action='store_true', help='Connect to the MQTT broker using MQTT v5 (default: false, use MQTT v3.1.1)')
+parser.add_argument('--mqtt-image-expiry', type=int, default=0, help='Seconds after which the broker discards image payloads, 0 to keep them (only with MQTT v5, default: 0)')
+parser.add_argument('--mqtt-topic-aliases', type=int, default=16, help='Maximum number of topic aliases to use, limited by the broker (only with MQTT v5, default: 16)')
+parser.add_argument('--mqtt-label-topics', type=int, default=20, help='Maximum number of retained per-label/per-face Deepstack topics, 0 for no limit (default: 20)')
+parser.add_argument('--mqtt-refresh-interval', type=int, default=0, help='Seconds after which unchanged retained topics are published again, 0 to only refresh on reconnect (default: 0)')
 parser.add_argument('--mqtt-client-id', type=str, default='foscam2mqtt', help='MQTT client ID to use for connecting (default: foscam2mqtt)')
 parser.add_argument('--ha-discovery', action='store_true', help='Enable publishing to Home Assistant discovery topic (default: false)')
 parser.add_argument('--ha-discovery-topic', type=str, default='homeassistant', help='MQTT topic to publish HA discovery information to (default: homeassistant)')
@@ -49,6 +75,13 @@ parser.add_argument('--deepstack-face', action='store_true', help='Send image to
 parser.add_argument('--deepstack-object', action='store_true', help='Send image to Deepstack on motion detection for object detection (default: false)')
 parser.add_argument('--deepstack-url', type=str, default='http://localhost:5000', help='The URL where Deepstack can be found')
 parser.add_argument('--deepstack-api-key', type=str, help='API key to authenticate against Deepstack (default: none)')
+parser.add_argument('--deepstack-cache-size', type=int, default=0, help='Number of Deepstack results to cache, 0 to disable (default: 0)')
+parser.add_argument('--deepstack-cache-ttl', type=int, default=60, help='Seconds a cached Deepstack result stays valid (default: 60)')
+parser.add_argument('--deepstack-cache-distance', type=int, default=4, help='Maximum Hamming distance between image hashes to reuse a cached object detection result, face recognition requires an exact match (default: 4)')
+parser.add_argument('--image-workers', type=int, default=0, help='Number of worker processes to annotate and encode Deepstack images, 0 to do this in the webhook thread (default: 0)')
+parser.add_argument('--motion-filter', action='store_true', help='Only send image to Deepstack for object detection if the frame changed, requires numpy (default: false)')
+parser.add_argument('--motion-filter-threshold', type=float, default=0.01, help='Fraction of the frame that should change to run object detection (default: 0.01)')
+parser.add_argument('--motion-filter-pixel', type=int, default=25, help='Grayscale difference (0-255) for a pixel to count as changed (default: 25)')
 parser.add_argument('--quiet', action='store_true', help='Only show error and critical messages in console (default: false)')
 parser.add_argument('--log-level', type=str, default='warning', choices=['debug','info','warning','error'], help='Log level (default: warning)')
 parser.add_argument('--date-format', type=str, default='%Y-%m-%d %H:%M:%S', help='Date/time format for logging (strftime template)')
@@ -82,16 +115,267 @@ log.addHandler(ch)
 log.info(f"Log level: {config.log_level.upper()}")
 log.info(f"Listening on {config.listen_address}:{str(config.listen_port)}")
 
+# Difference hash of an image, similar images give hashes with a small Hamming distance
+def image_dhash(image_data, hash_size = 8):
+    image = Image.open(BytesIO(image_data)).convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = image.tobytes()
+    image_hash = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            image_hash = (image_hash << 1) | (left > right)
+    return image_hash
+
+# LRU cache with TTL for Deepstack predictions, keyed by endpoint and image hash
+class DeepstackCache:
+    def __init__(self, size = 32, ttl = 60, distance = 4):
+        self.size = size
+        self.ttl = ttl
+        self.distance = distance
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.saved_time = 0.0
+
+    def get(self, endpoint, image_hash, distance = None):
+        if distance is None:
+            distance = self.distance
+        now = monotonic()
+        with self.lock:
+            for key, (predictions, duration, created) in list(self.entries.items()):
+                if now - created > self.ttl:
+                    del self.entries[key]
+
+            # Use the closest match, the most recently used one if there's a tie
+            best_key, best_distance = None, None
+            for key in reversed(self.entries):
+                key_distance = bin(key[1] ^ image_hash).count('1')
+                if key[0] == endpoint and key_distance <= distance and (best_distance is None or key_distance < best_distance):
+                    best_key, best_distance = key, key_distance
+
+            if best_key is None:
+                self.misses += 1
+                return None
+            predictions, duration, created = self.entries[best_key]
+            self.entries.move_to_end(best_key)
+            self.hits += 1
+            self.saved_time += duration
+            return predictions
+
+    def put(self, endpoint, image_hash, predictions, duration):
+        with self.lock:
+            self.entries[(endpoint, image_hash)] = (predictions, duration, monotonic())
+            self.entries.move_to_end((endpoint, image_hash))
+            while len(self.entries) > self.size:
+                self.entries.popitem(last = False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0,
+                'saved_time': round(self.saved_time, 3),
+            }
+
+# Load the font once per process
+_font = None
+def deepstack_font():
+    global _font
+    if _font is None:
+        _font = ImageFont.truetype(font='/fonts/noto.ttf', size=24)
+    return _font
+
+# Draw detected objects on a copy of the image per label, returns JPEG data per label
+def render_objects(image, predictions, date_time):
+    images = {}
+    color = (255, 255, 255, 128)
+    for entity in predictions:
+        label = entity['label']
+        if not label in images.keys():
+            images[label] = image.copy()
+        draw = ImageDraw.Draw(images[label])
+        confidence = entity['confidence']
+        x_min = max(int(entity["x_min"]) - 10, 0)
+        y_min = max(int(entity["y_min"]) - 10, 0)
+        x_max = min(int(entity["x_max"]) + 10, image.width)
+        y_max = min(int(entity["y_max"]) + 10, image.height)
+        draw.rectangle((x_min, y_min, x_max, y_max), outline=color)
+        draw.text((x_min + 10, y_min + 10), text=f"{label} ({str(round(confidence, 2))})", font=deepstack_font(), fill=color)
+    payloads = {}
+    for label, label_image in images.items():
+        ImageDraw.Draw(label_image).text((8, 8), text=date_time, font=deepstack_font(), fill=color)
+        image_payload = BytesIO()
+        label_image.save(image_payload, 'JPEG')
+        payloads[label] = image_payload.getvalue()
+    return payloads
+
+# Crop each recognized face, returns JPEG data in order of the predictions
+def render_faces(image, predictions):
+    payloads = []
+    for entity in predictions:
+        x_min = max(int(entity["x_min"]) - 10, 0)
+        y_min = max(int(entity["y_min"]) - 10, 0)
+        x_max = min(int(entity["x_max"]) + 10, image.width)
+        y_max = min(int(entity["y_max"]) + 10, image.height)
+        image_payload = BytesIO()
+        image.crop((x_min, y_min, x_max, y_max)).save(image_payload, 'JPEG')
+        payloads.append(image_payload.getvalue())
+    return payloads
+
+# Runs in a worker process, the image data is read from shared memory instead of being pickled
+def render_shared(render, shm_name, size, *args):
+    try:
+        shm = SharedMemory(name = shm_name, track = False)
+    except TypeError:
+        # Python < 3.13 always tracks shared memory, the parent process unlinks it
+        shm = SharedMemory(name = shm_name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    try:
+        with shm.buf[:size] as image_data:
+            image = Image.open(BytesIO(image_data))
+            image.load()
+    finally:
+        shm.close()
+    return render(image, *args)
+
+# Compare each frame to the previous one on a downscaled grayscale grid to find the region that changed
+class MotionFilter:
+    def __init__(self, threshold = 0.01, pixel_threshold = 25, grid = (64, 48), padding = 0.1):
+        self.threshold = threshold
+        self.pixel_threshold = pixel_threshold
+        self.grid = grid
+        self.padding = padding
+        self.previous = None
+        self.lock = Lock()
+        self.passed = 0
+        self.skipped = 0
+
+    def check(self, image_data):
+        image = Image.open(BytesIO(image_data))
+        frame = np.asarray(image.convert('L').resize(self.grid, Image.BILINEAR), dtype=np.int16)
+        # Subtract the median brightness so global lighting changes don't count as motion,
+        # unlike the mean it isn't shifted by a change covering less than half of the frame
+        frame = frame - int(np.median(frame))
+        with self.lock:
+            previous, self.previous = self.previous, frame
+
+        if previous is None:
+            change = 1.0
+            changed = np.ones(frame.shape, dtype=bool)
+        else:
+            changed = np.abs(frame - previous) > self.pixel_threshold
+            change = float(changed.mean())
+
+        with self.lock:
+            if change < self.threshold:
+                self.skipped += 1
+                return change, None
+            self.passed += 1
+
+        # Scale the bounding box of changed grid cells back to the image, with some padding around it
+        rows = np.flatnonzero(changed.any(axis = 1))
+        cols = np.flatnonzero(changed.any(axis = 0))
+        scale_x = image.width / self.grid[0]
+        scale_y = image.height / self.grid[1]
+        pad_x = int(image.width * self.padding)
+        pad_y = int(image.height * self.padding)
+        x_min = max(int(cols[0] * scale_x) - pad_x, 0)
+        y_min = max(int(rows[0] * scale_y) - pad_y, 0)
+        x_max = min(int((cols[-1] + 1) * scale_x) + pad_x, image.width)
+        y_max = min(int((rows[-1] + 1) * scale_y) + pad_y, image.height)
+        return change, (x_min, y_min, x_max, y_max)
+
+    def stats(self):
+        checks = self.passed + self.skipped
+        return {
+            'passed': self.passed,
+            'skipped': self.skipped,
+            'skip_rate': round(self.skipped / checks, 3) if checks else 0,
+        }
+
+# Token bucket per remote address
+class RateLimiter:
+    def __init__(self, rate = 1.0, burst = 10, max_sources = 1024):
+        self.rate = rate
+        self.burst = burst
+        self.max_sources = max_sources
+        self.buckets = OrderedDict()
+        self.lock = Lock()
+
+    def allow(self, source):
+        now = monotonic()
+        with self.lock:
+            tokens, last = self.buckets.pop(source, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[source] = (tokens, now)
+            # Forget the least recently seen addresses
+            while len(self.buckets) > self.max_sources:
+                self.buckets.popitem(last = False)
+        return allowed
+
+# Count rejected webhook requests and log a summary at most once per interval instead of a line per request
+class RejectCounter:
+    def __init__(self, interval = 60):
+        self.interval = interval
+        self.totals = dict()
+        self.counts = dict()
+        self.sources = set()
+        self.last_log = monotonic() - interval
+        self.lock = Lock()
+
+    def add(self, reason, source):
+        with self.lock:
+            self.totals[reason] = self.totals.get(reason, 0) + 1
+            self.counts[reason] = self.counts.get(reason, 0) + 1
+            if len(self.sources) < 100:
+                self.sources.add(source)
+        return self.flush()
+
+    # Log the rejections counted since the last summary, once the interval has passed
+    def flush(self):
+        now = monotonic()
+        with self.lock:
+            if not self.counts or now - self.last_log < self.interval:
+                return False
+            counts, sources = self.counts, self.sources
+            self.counts, self.sources = dict(), set()
+            self.last_log = now
+        details = ', '.join(f"{reason}: {str(count)}" for reason, count in counts.items())
+        log.warning(f"Rejected {str(sum(counts.values()))} webhook requests from {str(len(sources))} addresses ({details}): {', '.join(sorted(sources)[:5])}")
+        return True
+
+    def stats(self):
+        with self.lock:
+            return dict(self.totals)
+
 class Foscam2MQTT:
-    def __init__(self, listen_url, obfuscate = False, paranoid = False, quiet = False):
+    def __init__(self, listen_url, obfuscate = False, paranoid = False, webhook_secret = None, quiet = False):
         # Own settings
         self.actions = 'button','motion','sound','face','human' #,'alarm'
         self.listen_url = listen_url
         self.paranoid = False
         self.date_format = '%Y-%m-%dT%H:%M:%SZ'
         self.obfuscate = obfuscate
-
-        if self.obfuscate:
+        self.webhook_secret = None
+        self.webhook_rotation = 0
+        self.webhook_limiter = None
+        self.webhook_rejects = RejectCounter()
+
+        if self.obfuscate and webhook_secret:
+            # Signed actions are derived from the secret, so every instance shares them without any state
+            self.webhook_secret = webhook_secret.encode('utf-8')
+            if paranoid:
+                log.warning('Paranoid mode is not available with a webhook secret, use webhook rotation instead')
+            self.trigger_payload = hmac.new(self.webhook_secret, b'trigger', sha256).hexdigest()[:8]
+        elif self.obfuscate:
             self.action_keys = dict()
             self.paranoid = paranoid
             self.trigger_payload = ''.join(rnd.choices(string.ascii_uppercase + string.ascii_lowercase + string.digits, k=8))
@@ -103,14 +387,18 @@ class Foscam2MQTT:
         self.foscam_port = None
         self.foscam_user = None
         self.foscam_pass = None
+        self.foscam_available = True
+        self.foscam_latency = deque(maxlen = 10)
+        self.health_interval = 0
+        self.health_max_interval = 300
 
         # Foscam device settings
         self.foscam_status_led = None
         self.foscam_night_mode = None
         self.foscam_ring_volume = None
         self.foscam_image_hdr = None
-        self.foscam_mirror = None
-        self.foscam_flip = None
+        self.foscam_image_mirror = None
+        self.foscam_image_flip = None
 
         # MQTT settings
         self.mqtt_host = 'localhost'
@@ -121,6 +409,24 @@ class Foscam2MQTT:
         self.mqtt_client_id = 'foscam2mqtt'
         self.mqtt_settings = None
         self.mqtt_topic = 'foscam2mqtt'
+        self.mqtt_refresh_interval = 0
+        self.mqtt_protocol = mqtt.MQTTv311
+        self.mqtt_image_expiry = 0
+        # Topic aliases are assigned per connection to topics that are published more than once
+        self.mqtt_topic_alias_max = 16
+        self.mqtt_topic_alias_limit = 0
+        self.mqtt_topic_aliases = dict()
+        self.mqtt_topics_seen = set()
+        self.mqtt_alias_lock = Lock()
+        # Per-label Deepstack topics, least recently used first
+        self.mqtt_label_topics = OrderedDict()
+        self.mqtt_label_topics_max = 20
+        self.mqtt_label_lock = Lock()
+        # Last published payload per retained topic, to skip publishing values that didn't change
+        self.mqtt_published = dict()
+        self.mqtt_published_lock = Lock()
+        self.mqtt_published_count = 0
+        self.mqtt_suppressed_count = 0
         self.ha_discovery = False
         self.ha_discovery_topic = 'homeassistant'
         self.ha_device_name = 'Foscam VD1'
@@ -128,18 +434,46 @@ class Foscam2MQTT:
         # Deepstack settings
         self.deepstack_url = None
         self.deepstack_api_key = None
+        self.deepstack_cache = None
+        self.motion_filter = None
+        self.image_pool = None
 
         log.info('Foscam2MQTT initialized')
 
+    def action_epoch(self):
+        if self.webhook_rotation:
+            return int(time() // self.webhook_rotation)
+        return 0
+
+    def sign_action(self, action_name, epoch):
+        mac = hmac.new(self.webhook_secret, f"{action_name}:{str(epoch)}".encode('ascii'), sha256).hexdigest()[:32]
+        return f"{str(epoch)}.{mac}"
+
+    def verify_signed_action(self, action):
+        # Accept the current and the previous epoch, the device might not have been updated yet
+        epoch, _, mac = action.partition('.')
+        current_epoch = self.action_epoch()
+        if not (epoch.isascii() and epoch.isdigit()) or int(epoch) not in (current_epoch, current_epoch - 1):
+            return False
+        for action_name in self.actions:
+            if hmac.compare_digest(self.sign_action(action_name, int(epoch)), action):
+                return action_name
+        return False
+
+    def action_expired(self, action):
+        return self.webhook_secret is not None and action.partition('.')[0] != str(self.action_epoch())
+
     def verify_action(self, action):
-        if self.obfuscate and action in (self.action_keys.keys()):
+        if self.obfuscate and self.webhook_secret:
+            return self.verify_signed_action(action)
+        elif self.obfuscate and action in (self.action_keys.keys()):
             return self.action_keys[action]
         elif not self.obfuscate and action in self.actions:
             return action
         else:
             return False
 
-    def invoke_foscam(self, cmd, options = None, return_response = False):
+    def _request_foscam(self, cmd, options = None):
         foscam_url = f"http://{self.foscam_host}:{str(self.foscam_port)}/cgi-bin/CGIProxy.fcgi"
         params = {
             'usr': self.foscam_user,
@@ -148,91 +482,143 @@ class Foscam2MQTT:
         }
         if options:
             params.update(options)
+        start_time = monotonic()
+        response = requests.get(foscam_url, params = params, timeout = 15, verify = False)
+        # Any response counts for the latency, even an HTTP error
+        self.foscam_latency.append(monotonic() - start_time)
+        log.debug(f"Request URL: {response.url}")
+        response.raise_for_status()
+        return response
+
+    def invoke_foscam(self, cmd, options = None, return_response = False):
+        # Fail fast while the health probe considers the device unreachable
+        if not self.foscam_available:
+            log.debug(f"Foscam device unavailable, not sending {cmd}")
+            return False
+
         try:
-            response = requests.get(foscam_url, params = params, timeout = 15, verify = False)
-            log.debug(f"Request URL: {response.url}")
-            response.raise_for_status()
+            response = self._request_foscam(cmd, options)
         except requests.exceptions.HTTPError as errh:
-            if response.status_code == 404:
+            if errh.response is not None and errh.response.status_code == 404:
                 log.warning('Remote server returned HTTP error code 404')
             else:
                 log.warning(errh)
             return False
-        except req.exceptions.ConnectionError as errc:
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as errc:
             log.warning(errc)
+            # Let the health probe find out when the device is back
+            if self.health_interval:
+                self.foscam_available = False
             return False
-        except req.exceptions.Timeout as errt:
-            log.warning(errt)
-            return False
-        except req.exceptions.RequestException as err:
+        except requests.exceptions.RequestException as err:
             log.warning(err)
             return False
         if return_response: return response.content
 
-    def update_foscam_settings(self):
-        _any_change = False
-
-        _status_led = int(xmlparse(self.invoke_foscam(cmd='getLedEnableState', return_response=True))['CGI_Result']['isEnable'])
-        log.debug(f"Retrieved status LED setting from device: {str(_status_led)}")
-        if _status_led != self.foscam_status_led:
-            self.self.foscam_status_led = _status_led
-            self.mqtt_publish('status_led', _status_led)
-            _any_change = True
+    def health_probe(self):
+        interval = self.health_interval
+        while True:
+            try:
+                # Only connection errors and timeouts mean unreachable, an HTTP error still is an answer from the device
+                try:
+                    self._request_foscam('getDevState')
+                    available = True
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as errc:
+                    log.debug(f"Health probe failed: {errc}")
+                    available = False
+                except requests.exceptions.RequestException as err:
+                    log.warning(f"Health probe got an error from the device: {err}")
+                    available = True
+                if available != self.foscam_available:
+                    if available:
+                        log.warning('Foscam device is reachable again')
+                    else:
+                        log.warning('Foscam device is unreachable')
+                was_available, self.foscam_available = self.foscam_available, available
+                self.mqtt_publish('camera/$state', int(available))
+
+                if available:
+                    latencies = list(self.foscam_latency)
+                    if latencies:
+                        latency = sum(latencies) / len(latencies)
+                        self.mqtt_publish('camera/latency', round(latency * 1000))
+                    if not was_available:
+                        self.update_foscam_settings()
+                    interval = self.health_interval
+                else:
+                    # Back off exponentially while the device is down
+                    interval = min(interval * 2, self.health_max_interval)
+            except Exception as err:
+                # Keep probing, otherwise the device would stay unavailable until a restart
+                log.error(f"Health probe failed: {err}")
+            sleep(interval)
+
+    def foscam_result(self, cmd):
+        response = self.invoke_foscam(cmd = cmd, return_response = True)
+        if response is False:
+            log.warning(f"No response from Foscam device for {cmd}")
+            return None
+        return xmlparse(response)['CGI_Result']
 
-        infra_led_mode = int(xmlparse(self.invoke_foscam(cmd='getInfraLedConfig', return_response=True))['CGI_Result']['mode'])
+    def update_foscam_settings(self):
+        if not self.foscam_available:
+            log.debug('Foscam device unavailable, not updating settings')
+            return
+
+        # Unchanged values are filtered out by mqtt_publish, so publish everything we retrieve
+        result = self.foscam_result('getLedEnableState')
+        if result is None: return
+        self.foscam_status_led = int(result['isEnable'])
+        log.debug(f"Retrieved status LED setting from device: {str(self.foscam_status_led)}")
+        self.mqtt_publish('status_led', self.foscam_status_led)
+
+        result = self.foscam_result('getInfraLedConfig')
+        if result is None: return
+        infra_led_mode = int(result['mode'])
         log.debug(f"Retrieved infra LED mode from device: {str(infra_led_mode)} (0 = auto, 1 = manual)")
         if infra_led_mode == 0:
-            _night_mode = 'auto'
+            self.foscam_night_mode = 'auto'
         else:
-            infra_led_state = int(xmlparse(self.invoke_foscam(cmd='getDevState', return_response=True))['CGI_Result']['infraLedState'])
+            result = self.foscam_result('getDevState')
+            if result is None: return
+            infra_led_state = int(result['infraLedState'])
             log.debug(f"Retrieved infra LED state from device: {str(infra_led_state)}")
             if infra_led_state == 1:
-                _night_mode = 'on'
+                self.foscam_night_mode = 'on'
             else:
-                _night_mode = 'off'
-        log.debug(f"Night mode: {_night_mode}")
-        if _night_mode != self.foscam_night_mode:
-            self.foscam_night_mode = _night_mode
-            self.mqtt_publish('night_mode', _night_mode)
-            _any_change = True
-
-        _ring_volume = int(xmlparse(self.invoke_foscam(cmd='getAudioVolume', return_response=True))['CGI_Result']['volume'])
-        log.debug(f"Retrieved volume setting from device: {str(_ring_volume)}")
-        if self.foscam_ring_volume != _ring_volume:
-            self.foscam_ring_volume = _ring_volume
-            self.mqtt_publish('ring_volume', _ring_volume)
-            _any_change = True
-
-        _image_hdr = int(xmlparse(self.invoke_foscam(cmd='getHdrMode', return_response=True))['CGI_Result']['mode'])
-        log.debug(f"Retrieved image HDR setting from device: {str(_image_hdr)}")
-        if self.foscam_image_hdr != _image_hdr:
-            self.self.foscam_image_hdr = _image_hdr
-            self.mqtt_publish('image/hdr', _image_hdr)
-            _any_change = True
-
-        _image_mirror_flip = xmlparse(self.invoke_foscam(cmd='getMirrorAndFlipSetting', return_response=True))['CGI_Result']
-        _image_mirror = _image_mirror_flip['isMirror']
-        _image_flip = _image_mirror_flip['isFlip']
-        log.debug(f"Retrieved image mirror/flip settings from device, mirror: {str(_image_mirror)}, flip: {str(_image_flip)}")
-        if self.foscam_image_mirror != _image_mirror:
-            self.foscam_image_mirror = _image_mirror
-            self.mqtt_publish('image/mirror', _image_mirror)
-            _any_change = True
-        if self.foscam_image_flip != _image_flip:
-            self.foscam_image_flip = _image_flip
-            self.mqtt_publish('image/flip', _image_flip)
-            _any_change = True
-
-        if _any_change:
-            _settings = dict()
-            _settings['status_led'] = _status_led
-            _settings['night_mode'] = _night_mode
-            _settings['ring_volume'] = _ring_volume
-            _settings['image_hdr'] = _image_hdr
-            _settings['image_mirror'] = _image_mirror
-            _settings['image_flip'] = _image_flip
-            settings_json = json_dumps(_settings)
-            self.mqtt_publish('settings', settings_json)
+                self.foscam_night_mode = 'off'
+        log.debug(f"Night mode: {self.foscam_night_mode}")
+        self.mqtt_publish('night_mode', self.foscam_night_mode)
+
+        result = self.foscam_result('getAudioVolume')
+        if result is None: return
+        self.foscam_ring_volume = int(result['volume'])
+        log.debug(f"Retrieved volume setting from device: {str(self.foscam_ring_volume)}")
+        self.mqtt_publish('ring_volume', self.foscam_ring_volume)
+
+        result = self.foscam_result('getHdrMode')
+        if result is None: return
+        self.foscam_image_hdr = int(result['mode'])
+        log.debug(f"Retrieved image HDR setting from device: {str(self.foscam_image_hdr)}")
+        self.mqtt_publish('image/hdr', self.foscam_image_hdr)
+
+        _image_mirror_flip = self.foscam_result('getMirrorAndFlipSetting')
+        if _image_mirror_flip is None: return
+        self.foscam_image_mirror = _image_mirror_flip['isMirror']
+        self.foscam_image_flip = _image_mirror_flip['isFlip']
+        log.debug(f"Retrieved image mirror/flip settings from device, mirror: {str(self.foscam_image_mirror)}, flip: {str(self.foscam_image_flip)}")
+        self.mqtt_publish('image/mirror', self.foscam_image_mirror)
+        self.mqtt_publish('image/flip', self.foscam_image_flip)
+
+        _settings = dict()
+        _settings['status_led'] = self.foscam_status_led
+        _settings['night_mode'] = self.foscam_night_mode
+        _settings['ring_volume'] = self.foscam_ring_volume
+        _settings['image_hdr'] = self.foscam_image_hdr
+        _settings['image_mirror'] = self.foscam_image_mirror
+        _settings['image_flip'] = self.foscam_image_flip
+        settings_json = json_dumps(_settings)
+        self.mqtt_publish('settings', settings_json)
 
     def snapshot(self):
         snapshot = self.invoke_foscam(cmd = 'snapPicture2', return_response = True)
@@ -260,7 +646,9 @@ class Foscam2MQTT:
             self.invoke_foscam(cmd=f"set{foscam_cmd}Config", options = foscam_options)
 
         for action_name, alias in action_aliases.items():
-            if self.obfuscate:
+            if self.obfuscate and self.webhook_secret:
+                action = self.sign_action(action_name, self.action_epoch())
+            elif self.obfuscate:
                 if triggered_action is None or triggered_action == action_name:
                     rnd.seed()
                     random_string = ''.join(rnd.choices(string.ascii_uppercase + string.ascii_lowercase + string.digits, k=24))
@@ -270,7 +658,7 @@ class Foscam2MQTT:
                     alarm_url_enc = unquote(alarm_urls[alias])
                     alarm_url_byte = b64dec(alarm_url_enc)
                     alarm_url = alarm_url_byte.decode('ascii')
-                    log.debug(f"Retrieved existing URL for action {action}: {alarm_url}")
+                    log.debug(f"Retrieved existing URL for action {action_name}: {alarm_url}")
                     if self.listen_url in alarm_url:
                         action = alarm_url.replace((f"{self.listen_url}?action="), '')
                         log.debug(f"Extracted action: {action}")
@@ -282,16 +670,37 @@ class Foscam2MQTT:
             log.debug(f"Generated URL for {action_name} - {action_url}")
             encoded_url = b64enc(action_url.encode('ascii'))
             foscam_options[alias] = encoded_url.decode('ascii')
-        self.invoke_foscam(cmd = 'setAlarmHttpServer', options = foscam_options, return_response = True)
+        return self.invoke_foscam(cmd = 'setAlarmHttpServer', options = foscam_options, return_response = True) is not False
+
+    def rotate_hooks(self):
+        # Push newly signed actions to the device at the start of each epoch, retry until the device accepts them
+        while True:
+            sleep(self.webhook_rotation - time() % self.webhook_rotation)
+            log.info('Webhook rotation interval passed, updating webhooks')
+            retry = 10
+            while True:
+                try:
+                    if self.update_hooks():
+                        break
+                    log.warning(f"Unable to update webhooks, retrying in {str(retry)} seconds")
+                except Exception as err:
+                    log.warning(f"Unable to update webhooks, retrying in {str(retry)} seconds: {err}")
+                sleep(retry)
+                retry = min(retry * 2, 300)
 
     def mqtt_gen_topic(self, sub_topic, main_topic = None):
         if main_topic is None: main_topic = self.mqtt_topic
         return f"{main_topic}/{sub_topic}"
 
-    def mqtt_init(self, host, port = 1883, ssl = False, username = None, password = None, client_id = 'foscam2mqtt', topic = 'foscam2mqtt'):
+    def mqtt_init(self, host, port = 1883, ssl = False, username = None, password = None, client_id = 'foscam2mqtt', topic = 'foscam2mqtt', protocol = mqtt.MQTTv311):
         log.info(f"Initializing MQTT client with ID {client_id}")
         self.mqtt_client_id = client_id
-        self.mqtt_client = mqtt.Client(protocol=mqtt.MQTTv311, client_id = client_id, clean_session = False)
+        self.mqtt_protocol = protocol
+        if protocol == mqtt.MQTTv5:
+            log.info('Using MQTT v5')
+            self.mqtt_client = mqtt.Client(protocol = protocol, client_id = client_id)
+        else:
+            self.mqtt_client = mqtt.Client(protocol = protocol, client_id = client_id, clean_session = False)
 
         self.mqtt_host = host
         self.mqtt_port = port
@@ -300,7 +709,7 @@ class Foscam2MQTT:
         log.info(f"MQTT base topic is {topic}")
 
         self.mqtt_settings = {
-            'protocol':  mqtt.MQTTv311,
+            'protocol':  protocol,
             'client_id': client_id,
             'hostname': host,
             'port': port,
@@ -316,10 +725,14 @@ class Foscam2MQTT:
             log.info(f"Camera name is {self.ha_device_name}")
 
         self.mqtt_client.on_connect = self.mqtt_on_connect
+        self.mqtt_client.on_disconnect = self.mqtt_on_disconnect
         # self.mqtt_client.on_message = self.mqtt_on_message
 
         log.info(f"Connect to MQTT broker {self.mqtt_host}:{str(self.mqtt_port)}")
-        self.mqtt_client.connect(self.mqtt_host, self.mqtt_port, 60)
+        if protocol == mqtt.MQTTv5:
+            self.mqtt_client.connect(self.mqtt_host, self.mqtt_port, 60, clean_start = False)
+        else:
+            self.mqtt_client.connect(self.mqtt_host, self.mqtt_port, 60)
 
         log.debug(f"Add callback for topic {self.mqtt_gen_topic('snapshot/update')}")
         self.mqtt_client.message_callback_add(self.mqtt_gen_topic('snapshot/update'), self.mqtt_on_snapshot_update)
@@ -347,18 +760,37 @@ class Foscam2MQTT:
 
     def mqtt_disconnect(self):
         log.debug(f"Publish 0 to topic {self.mqtt_gen_topic('$state')}")
-        self.mqtt_publish('$state', 0, qos = 2)
+        self.mqtt_publish('$state', 0, qos = 2, force = True)
         log.info('Disconnect')
         self.mqtt_client.disconnect()
 
-    def mqtt_publish(self, topic, payload, qos = 0, retain = True):
+    def mqtt_publish(self, topic, payload, qos = 0, retain = True, force = False):
         if not self.mqtt_client:
             log.error('MQTT not initialized, run self.mqtt_init first!')
             return False
 
         topic = self.mqtt_gen_topic(topic)
 
-        self.mqtt_client.publish(topic, payload, qos = qos, retain = retain)
+        # The broker already retains the last payload, skip publishing it again unless a refresh is due
+        if retain:
+            if type(payload) is bytes:
+                digest = sha1(payload).digest()
+            else:
+                digest = str(payload)
+            now = monotonic()
+            with self.mqtt_published_lock:
+                published = self.mqtt_published.get(topic)
+                if not force and published and published[0] == digest and (not self.mqtt_refresh_interval or now - published[1] < self.mqtt_refresh_interval):
+                    self.mqtt_suppressed_count += 1
+                    log.debug(f"Payload for topic {topic} did not change, not publishing")
+                    return
+                self.mqtt_published[topic] = (digest, now)
+
+        if self.mqtt_protocol == mqtt.MQTTv5:
+            self._mqtt_publish_v5(topic, payload, qos, retain)
+        else:
+            self.mqtt_client.publish(topic, payload, qos = qos, retain = retain)
+        self.mqtt_published_count += 1
 
         if log.level <= logging.DEBUG:
             if type(payload) is int:
@@ -369,6 +801,49 @@ class Foscam2MQTT:
                 payload = f"of type {type(payload).__name__}"
             log.debug(f"Published payload {payload} to topic {topic}")
 
+    def _mqtt_publish_v5(self, topic, payload, qos, retain):
+        properties = Properties(PacketTypes.PUBLISH)
+        if self.mqtt_image_expiry and type(payload) is bytes and payload:
+            properties.MessageExpiryInterval = self.mqtt_image_expiry
+
+        # Publish under the lock, so the message that sets an alias is queued before any message using it.
+        # Only QoS 0 messages use aliases, others may be resent on a new connection where the alias is unknown.
+        with self.mqtt_alias_lock:
+            alias = self.mqtt_topic_aliases.get(topic) if qos == 0 else None
+            publish_topic = topic
+            if alias:
+                publish_topic = ''
+            elif qos == 0 and topic in self.mqtt_topics_seen and len(self.mqtt_topic_aliases) < self.mqtt_topic_alias_limit:
+                alias = len(self.mqtt_topic_aliases) + 1
+                self.mqtt_topic_aliases[topic] = alias
+                log.debug(f"Assigned topic alias {str(alias)} to topic {topic}")
+            else:
+                self.mqtt_topics_seen.add(topic)
+            if alias:
+                properties.TopicAlias = alias
+            msg_info = self.mqtt_client.publish(publish_topic, payload, qos = qos, retain = retain, properties = properties)
+            # The broker never saw the alias if the message that sets it wasn't sent
+            if alias and publish_topic and msg_info.rc != mqtt.MQTT_ERR_SUCCESS:
+                del self.mqtt_topic_aliases[topic]
+
+    def mqtt_label_topic(self, label_topic):
+        # Keep a bounded number of per-label topics, clear the retained messages of the least recently used ones
+        evicted = []
+        with self.mqtt_label_lock:
+            self.mqtt_label_topics.pop(label_topic, None)
+            self.mqtt_label_topics[label_topic] = True
+            while self.mqtt_label_topics_max and len(self.mqtt_label_topics) > self.mqtt_label_topics_max:
+                evicted.append(self.mqtt_label_topics.popitem(last = False)[0])
+        for evicted_topic in evicted:
+            log.info(f"Too many label topics, removing retained messages from {self.mqtt_gen_topic(evicted_topic)}")
+            for sub_topic in ('snapshot', 'confidence', 'datetime'):
+                self.mqtt_publish(f"{evicted_topic}/{sub_topic}", b'', force = True)
+
+    def mqtt_refresh(self):
+        log.debug('Clear cache of published payloads, all retained topics will be published again')
+        with self.mqtt_published_lock:
+            self.mqtt_published.clear()
+
     def mqtt_gen_ha_entity(self, action, entity_type, availability_topic = None, name = None, params = None, device = None, icon = 'mdi:help-box'):
         unique_id = f"{self.mqtt_topic}_{action}"
         log.debug(f"Generated unique_id {unique_id}")
@@ -547,16 +1022,44 @@ class Foscam2MQTT:
         msg = self.mqtt_gen_ha_entity(name = f"{self.ha_device_name} ringer volume", action = action, entity_type = 'number', device = device, params = params)
         msgs.append(msg)
 
+        if self.health_interval:
+            # Device reachability and CGI response time, as reported by the health probe
+            action = 'camera_state'
+            params = {
+                'ic': 'mdi:lan-connect',
+                'stat_t': self.mqtt_gen_topic('camera/$state'),
+                'dev_cla': 'connectivity',
+                'pl_on': 1,
+                'pl_off': 0,
+            }
+            msg = self.mqtt_gen_ha_entity(name = f"{self.ha_device_name} connectivity", action = action, entity_type = 'binary_sensor', device = device, params = params)
+            msgs.append(msg)
+
+            action = 'camera_latency'
+            params = {
+                'ic': 'mdi:timer-outline',
+                'stat_t': self.mqtt_gen_topic('camera/latency'),
+                'unit_of_meas': 'ms',
+            }
+            msg = self.mqtt_gen_ha_entity(name = f"{self.ha_device_name} latency", action = action, entity_type = 'sensor', device = device, params = params)
+            msgs.append(msg)
+
         # TODO: night mode on/off/auto select, ring/speaker volume numeric
 
         mqtt_auth = {'username': self.mqtt_user, 'password': self.mqtt_pass}
-        mqtt_publish.multiple(msgs, hostname = self.mqtt_host, port = self.mqtt_port, auth = mqtt_auth)
+        mqtt_publish.multiple(msgs, hostname = self.mqtt_host, port = self.mqtt_port, auth = mqtt_auth, protocol = self.mqtt_protocol)
 
     # The callback for when the client receives a CONNACK response from the server.
-    def mqtt_on_connect(self, client, userdata, flags, rc):
+    def mqtt_on_connect(self, client, userdata, flags, rc, properties = None):
         # Do this in on_connect so they will be re-subscribed on a reconnect
         log.info('MQTT Connected')
 
+        # Topic aliases were reset on disconnect, the broker tells us how many we can use on this connection
+        with self.mqtt_alias_lock:
+            self.mqtt_topic_alias_limit = min(self.mqtt_topic_alias_max, getattr(properties, 'TopicAliasMaximum', 0))
+        if self.mqtt_protocol == mqtt.MQTTv5:
+            log.debug(f"Using up to {str(self.mqtt_topic_alias_limit)} topic aliases")
+
         # client.subscribe(self.mqtt_gen_topic('ring_volume/set'))
         # client.subscribe(self.mqtt_gen_topic('status_led/set'))
         # client.subscribe(self.mqtt_gen_topic('image/hdr/set'))
@@ -565,19 +1068,33 @@ class Foscam2MQTT:
         # client.subscribe(self.mqtt_gen_topic('hooks/update'))
         # client.subscribe(self.mqtt_gen_topic('snapshot/update'))
 
+        # Publish all state again after a reconnect
+        self.mqtt_refresh()
+
         log.debug(f"Publish 1 to topic {self.mqtt_gen_topic('$state')}")
         self.mqtt_publish('$state', 1, qos = 2)
 
         self.update_foscam_settings()
 
+    def mqtt_on_disconnect(self, client, userdata, rc, properties = None):
+        log.info('MQTT Disconnected')
+
+        # Stop using topic aliases right away, a reconnect opens the new connection before on_connect is called
+        with self.mqtt_alias_lock:
+            self.mqtt_topic_aliases.clear()
+            self.mqtt_topics_seen.clear()
+            self.mqtt_topic_alias_limit = 0
+
     # The callback for when a PUBLISH message is received from the server.
     def mqtt_on_message(self, client, userdata, msg):
         log.debug(f"MQTT message received {msg.topic} ({str(len(msg.payload))} bytes)")
 
     def mqtt_on_snapshot_update(self, client, userdata, msg):
         log.debug('Topic snapshot/update was triggered')
-        self.mqtt_publish('snapshot', self.snapshot())
-        self.mqtt_publish('snapshot/datetime', dt.strftime(dt.now(), self.date_format))
+        image_data = self.snapshot()
+        if image_data:
+            self.mqtt_publish('snapshot', image_data)
+            self.mqtt_publish('snapshot/datetime', dt.strftime(dt.now(), self.date_format))
 
     def mqtt_on_ring_volume_set(self, client, userdata, msg):
         ring_volume = int(msg.payload)
@@ -633,9 +1150,26 @@ class Foscam2MQTT:
         log.debug(f"Topic reboot was triggered")
         self.invoke_foscam(cmd = 'rebootSystem')
 
-    def _invoke_deepstack(self, endpoint, image_data):
+    def _invoke_deepstack(self, endpoint, image_data, region = None):
+        # Predictions for a cropped image are relative to the crop, so only reuse them for the same region
+        cache_key = endpoint if region is None else f"{endpoint}@{','.join(str(coord) for coord in region)}"
+        image_hash = None
+        if self.deepstack_cache:
+            try:
+                image_hash = image_dhash(image_data)
+            except (OSError, ValueError) as err:
+                log.warning(f"Unable to hash image for Deepstack cache: {err}")
+            if image_hash is not None:
+                # A similar frame might show a different person, only reuse face recognition for identical hashes
+                distance = 0 if endpoint.startswith('face') else None
+                predictions = self.deepstack_cache.get(cache_key, image_hash, distance)
+                if predictions is not None:
+                    log.debug(f"Deepstack cache hit for {endpoint}, image hash {image_hash:016x}")
+                    return self._deepstack_result(endpoint, predictions)
+
         deepstack_url = f"{self.deepstack_url}/v1/vision/{endpoint}"
         log.debug(f"Deepstack API endpoint: {deepstack_url}")
+        start_time = monotonic()
         try:
             request_args = {
                 'timeout': 5,
@@ -651,92 +1185,165 @@ class Foscam2MQTT:
             else:
                 log.warning(errh)
             return False
-        except req.exceptions.ConnectionError as errc:
+        except requests.exceptions.ConnectionError as errc:
             log.warning(errc)
             return False
-        except req.exceptions.Timeout as errt:
+        except requests.exceptions.Timeout as errt:
             log.warning(errt)
             return False
-        except req.exceptions.RequestException as err:
+        except requests.exceptions.RequestException as err:
             log.warning(err)
             return False
 
-        response = response.json()
+        predictions = response.json()['predictions']
+
+        # Empty results are cached as well, a quiet doorway mostly yields those
+        if image_hash is not None:
+            self.deepstack_cache.put(cache_key, image_hash, predictions, monotonic() - start_time)
 
-        if len(response['predictions']) > 0:
-            log.debug(f"Deepstack returned {str(response['predictions'])} predictions for {endpoint}.")
-            return response['predictions']
+        return self._deepstack_result(endpoint, predictions)
+
+    def _deepstack_result(self, endpoint, predictions):
+        if len(predictions) > 0:
+            log.debug(f"Deepstack returned {str(predictions)} predictions for {endpoint}.")
+            return predictions
         else:
             log.warning(f"No predictions returned for {endpoint}.")
             return False
 
+    def flush_rejects(self):
+        # Make sure the end of a burst of rejected requests gets logged and published as well
+        while True:
+            sleep(self.webhook_rejects.interval)
+            if self.webhook_rejects.flush():
+                self.mqtt_publish_stats()
+
+    def mqtt_publish_stats(self):
+        self.mqtt_publish('stats/webhook', json_dumps({'rejected': self.webhook_rejects.stats()}))
+        self.mqtt_publish('stats/mqtt', json_dumps({'published': self.mqtt_published_count, 'suppressed': self.mqtt_suppressed_count, 'label_topics': len(self.mqtt_label_topics)}))
+        if self.deepstack_cache:
+            self.mqtt_publish('stats/deepstack_cache', json_dumps(self.deepstack_cache.stats()))
+        if self.motion_filter:
+            self.mqtt_publish('stats/motion_filter', json_dumps(self.motion_filter.stats()))
+
+    def _render(self, render, image_data, *args):
+        if not self.image_pool:
+            return render(Image.open(BytesIO(image_data)), *args)
+
+        shm = SharedMemory(create = True, size = len(image_data))
+        try:
+            shm.buf[:len(image_data)] = image_data
+            return self.image_pool.apply_async(render_shared, (render, shm.name, len(image_data)) + args).get(timeout = 30)
+        except PoolTimeoutError:
+            log.warning(f"Image worker did not finish {render.__name__} within 30 seconds")
+            return None
+        finally:
+            shm.close()
+            shm.unlink()
+
     def deepstack_object(self, image_data, action = None):
-        predictions = self._invoke_deepstack('detection', image_data)
+        detect_data = image_data
+        crop_region = None
+        x_offset, y_offset = 0, 0
+        if self.motion_filter:
+            try:
+                change, region = self.motion_filter.check(image_data)
+            except (OSError, ValueError) as err:
+                log.warning(f"Unable to run motion filter, sending full frame to Deepstack: {err}")
+                change, region = None, None
+
+            if change is not None:
+                result = 'pass' if region else 'skip'
+                log.debug(f"Motion filter {result} for {action}, {str(round(change * 100, 2))}% of frame changed")
+                self.mqtt_publish(f"{action}/motion_filter", json_dumps({'result': result, 'change': round(change, 4)}))
+                if not region:
+                    return
+
+                # Only send the region that changed, predictions are moved back onto the full image
+                image = Image.open(BytesIO(image_data))
+                if region != (0, 0, image.width, image.height):
+                    crop_payload = BytesIO()
+                    image.crop(region).save(crop_payload, 'JPEG')
+                    detect_data = crop_payload.getvalue()
+                    crop_region = region
+                    x_offset, y_offset = region[0], region[1]
+
+        predictions = self._invoke_deepstack('detection', detect_data, crop_region)
+        if predictions and (x_offset or y_offset):
+            predictions = [dict(entity, x_min = entity['x_min'] + x_offset, x_max = entity['x_max'] + x_offset, y_min = entity['y_min'] + y_offset, y_max = entity['y_max'] + y_offset) for entity in predictions]
         if predictions:
             date_time = dt.strftime(dt.now(), self.date_format)
-            image = Image.open(BytesIO(image_data))
-            image_payload = BytesIO()
-            images = {}
-            font = ImageFont.truetype(font='/fonts/noto.ttf', size=24)
-            color = (255, 255, 255, 128)
             for entity in predictions:
-                label = entity['label']
-                if not label in images.keys():
-                    images[label] = image
-                draw = ImageDraw.Draw(images[label])
-                confidence = entity['confidence']
-                log.info(f"A {label} was detected by Deepstack with {str(round(confidence, 2))} confidence.")
-                x_min = max(int(entity["x_min"]) - 10, 0)
-                y_min = max(int(entity["y_min"]) - 10, 0)
-                x_max = min(int(entity["x_max"]) + 10, image.width)
-                y_max = min(int(entity["y_max"]) + 10, image.height)
-                draw.rectangle((x_min, y_min, x_max, y_max), outline=color)
-                draw.text((x_min + 10, y_min + 10), text=f"{label} ({str(round(confidence, 2))})", font=font, fill=color)
-            draw.text((8, 8), text=date_time, font=font, fill=color)
-            for label in images.keys():
-                images[label].save(image_payload, 'JPEG')
-                self.mqtt_publish(f"{action}/{label}/snapshot", image_payload.read())
+                log.info(f"A {entity['label']} was detected by Deepstack with {str(round(entity['confidence'], 2))} confidence.")
+            payloads = self._render(render_objects, image_data, predictions, date_time)
+            if not payloads:
+                return
+            for label, image_payload in payloads.items():
+                self.mqtt_label_topic(f"{action}/{label}")
+                self.mqtt_publish(f"{action}/{label}/snapshot", image_payload)
                 self.mqtt_publish(f"{action}/{label}/datetime", date_time)
 
     def deepstack_face(self, image_data, action = None):
         predictions = self._invoke_deepstack('face/recognize', image_data)
         if predictions:
             date_time = dt.strftime(dt.now(), self.date_format)
-            image = Image.open(BytesIO(image_data))
-            image_payload = BytesIO()
-            font = ImageFont.truetype(font='/fonts/noto.ttf', size=24)
-            for entity in predictions:
+            payloads = self._render(render_faces, image_data, predictions)
+            if not payloads:
+                return
+            for entity, image_payload in zip(predictions, payloads):
                 user_id = entity['userid']
                 confidence = entity['confidence']
                 log.info(f"{user_id} was detected by Deepstack with {str(round(confidence, 2))} confidence.")
-                x_min = max(int(entity["x_min"]) - 10, 0)
-                y_min = max(int(entity["y_min"]) - 10, 0)
-                x_max = min(int(entity["x_max"]) + 10, image.width)
-                y_max = min(int(entity["y_max"]) + 10, image.height)
-                image_crop = image.crop((x_min, y_min, x_max, y_max))
-                image_crop.save(image_payload, 'JPEG')
-                self.mqtt_publish(f"{action}/{user_id}/snapshot", image_payload.read())
+                self.mqtt_label_topic(f"{action}/{user_id}")
+                self.mqtt_publish(f"{action}/{user_id}/snapshot", image_payload)
                 self.mqtt_publish(f"{action}/{user_id}/confidence", confidence)
                 self.mqtt_publish(f"{action}/{user_id}/datetime", date_time)
 
-foscam = Foscam2MQTT(listen_url = config.listen_url, obfuscate = config.obfuscate, paranoid = config.paranoid)
+foscam = Foscam2MQTT(listen_url = config.listen_url, obfuscate = config.obfuscate, paranoid = config.paranoid, webhook_secret = config.webhook_secret)
 foscam.date_format = config.date_format
+foscam.mqtt_refresh_interval = config.mqtt_refresh_interval
+foscam.mqtt_image_expiry = config.mqtt_image_expiry
+foscam.mqtt_topic_alias_max = config.mqtt_topic_aliases
+foscam.mqtt_label_topics_max = config.mqtt_label_topics
+if config.webhook_rate > 0:
+    foscam.webhook_limiter = RateLimiter(rate = config.webhook_rate, burst = config.webhook_burst)
 foscam.foscam_host = config.foscam_host
 foscam.foscam_port = config.foscam_port
 foscam.foscam_user = config.foscam_user
 foscam.foscam_pass = config.foscam_pass
+foscam.health_interval = config.health_interval
+foscam.health_max_interval = config.health_max_interval
 
 foscam.deepstack_url = config.deepstack_url
 foscam.deepstack_api_key = config.deepstack_api_key
+if config.motion_filter:
+    if np is None:
+        log.error('The motion filter requires numpy, running object detection on every trigger')
+    else:
+        foscam.motion_filter = MotionFilter(threshold = config.motion_filter_threshold, pixel_threshold = config.motion_filter_pixel)
+if config.deepstack_cache_size > 0:
+    foscam.deepstack_cache = DeepstackCache(size = config.deepstack_cache_size, ttl = config.deepstack_cache_ttl, distance = config.deepstack_cache_distance)
+
+# Fork the image workers before any other threads are started
+if config.image_workers > 0:
+    log.info(f"Starting {str(config.image_workers)} image worker processes")
+    foscam.image_pool = get_context('fork').Pool(processes = config.image_workers)
+
+if foscam.webhook_secret:
+    foscam.webhook_rotation = config.webhook_rotation
 
 foscam.update_hooks()
 
+if foscam.webhook_rotation:
+    Thread(target = foscam.rotate_hooks, daemon = True).start()
+
 # Build MQTT config
 mqtt_config = {
     'host': config.mqtt_host,
     'port': config.mqtt_port,
     'client_id': config.mqtt_client_id,
     'topic': config.mqtt_topic,
+    'protocol': mqtt.MQTTv5 if config.mqtt_v5 else mqtt.MQTTv311,
 }
 
 # Add username/password if they're specified
@@ -758,36 +1365,48 @@ foscam.mqtt_publish('snapshot/datetime', dt.strftime(dt.now(), foscam.date_forma
 
 foscam.mqtt_client.loop_start()
 
+if foscam.health_interval:
+    Thread(target = foscam.health_probe, daemon = True).start()
+
+Thread(target = foscam.flush_rejects, daemon = True).start()
+
 # Define Flask web app
 app = Flask(__name__)
 
+def reject(reason, status):
+    if foscam.webhook_rejects.add(reason, req.remote_addr):
+        foscam.mqtt_publish_stats()
+    return res(response = f"ERROR - {reason.replace('_', ' ')}", status = status)
+
 @app.route('/', methods=['GET', 'PUT', 'POST'])
 def webhook():
-    ct = req.content_type
-    if req.method == 'GET':
-        req_args = req.args
-    elif req.method == 'POST' and ct == 'application/x-www-form-urlencoded':
-        req_args = req.form
-    elif req.method == 'POST' and ct == 'application/json':
-        req_args = req.json
-
-    date_time = dt.strftime(dt.now(), foscam.date_format)
-
-    if 'action' in req_args:
-        action = req_args['action']
-    else:
-        log.warning(f"No action specified - {req.remote_addr}")
-        response = f"{date_time} ERROR - no action specified"
-        return res(response=response, status=400)
-
-    verified_action = foscam.verify_action(action)
+    # Reject as cheaply as possible, no body parsing or logging for requests we won't handle
+    if foscam.webhook_limiter and not foscam.webhook_limiter.allow(req.remote_addr):
+        return reject('rate_limited', 429)
+
+    # Foscam devices pass the action in the query string, only look at small request bodies otherwise
+    action = req.args.get('action')
+    if action is None and req.method == 'POST' and req.content_length is not None and req.content_length <= 1024:
+        ct = req.content_type
+        if ct == 'application/x-www-form-urlencoded':
+            action = req.form.get('action')
+        elif ct == 'application/json':
+            req_json = req.get_json(silent = True)
+            if isinstance(req_json, dict):
+                action = req_json.get('action')
+
+    if not action:
+        return reject('no_action_specified', 400)
+
+    action_key = action
+    verified_action = foscam.verify_action(action) if len(action) <= 64 else False
     if not verified_action:
-        log.warning(f"Unknown action {action} - {req.remote_addr}")
-        response = f"{date_time} ERROR - unknown action"
-        return res(response = response, status = 400)
+        return reject('unknown_action', 400)
     else:
         action = verified_action
 
+    date_time = dt.strftime(dt.now(), foscam.date_format)
+
     log.info(f"{req.method} {action} - {req.remote_addr}")
 
     image_data = foscam.snapshot()
@@ -795,22 +1414,31 @@ def webhook():
     foscam.mqtt_publish('action', action, retain=False)
     foscam.mqtt_publish(f"{action}_datetime", dt.strftime(dt.now(), foscam.date_format))
 
-    foscam.mqtt_publish('snapshot', image_data)
-    foscam.mqtt_publish('snapshot/datetime', dt.strftime(dt.now(), foscam.date_format))
+    if image_data:
+        foscam.mqtt_publish('snapshot', image_data)
+        foscam.mqtt_publish('snapshot/datetime', dt.strftime(dt.now(), foscam.date_format))
 
     if foscam.ha_discovery:
         log.debug(f"Publishing payload {foscam.trigger_payload} to topic {action}/trigger")
         foscam.mqtt_publish(f"{action}/trigger", foscam.trigger_payload, retain = False)
 
-    if config.deepstack_face and verified_action in ['face', 'button']:
+    if not image_data:
+        log.warning(f"No snapshot available for {action}, skipping Deepstack")
+
+    elif config.deepstack_face and verified_action in ['face', 'button']:
         foscam.deepstack_face(image_data, verified_action)
 
     elif config.deepstack_object and verified_action in ['motion', 'sound']:
         foscam.deepstack_object(image_data, verified_action)
 
+    foscam.mqtt_publish_stats()
+
     if foscam.obfuscate and foscam.paranoid:
         log.info('Paranoid enabled, cycling webhook')
-        foscam.update_hooks(action = action)
+        foscam.update_hooks(triggered_action = action)
+    elif foscam.action_expired(action_key):
+        log.info('Webhook was triggered with a previous signed action, updating webhooks')
+        foscam.update_hooks()
 
     response = f"{date_time} OK"
     return res(response = response, status = 200)
@@ -828,5 +1456,8 @@ try:
 except OSError:
     log.debug('Caught expected error on process termination')
 
+if foscam.image_pool:
+    foscam.image_pool.terminate()
+
 # Set state to unavailable
 foscam.mqtt_disconnect()
\ No newline at end of file